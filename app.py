@@ -3,12 +3,30 @@
 # Flask + vanilla JS + Chart.js (one file)
 # Endpoints used:
 #   /suburb/market, /property/market
-# Auth styles tried in order: access_token query, x-api-key, Bearer
+# Auth styles tried concurrently: access_token query, x-api-key, Bearer
 # No demo data. If the API returns nothing, the cards stay blank and the debug strip explains why.
 
-import os, json
+import os, json, math, threading, time, gzip, hashlib, importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from flask import Flask, request, Response
-import requests
+from cachetools import TTLCache
+from urllib.parse import urlencode
+import httpx
+
+# Fastest JSON codec available: orjson, then ujson, then stdlib. Dumps always returns bytes.
+# orjson rejects NaN/Infinity on load, the others let them through so they get scrubbed
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(o): return orjson.dumps(o)
+except ImportError:
+    try:
+        import ujson
+        def json_loads(s): return _scrub_nan(ujson.loads(s))
+        def json_dumps(o): return ujson.dumps(o).encode()
+    except ImportError:
+        def json_loads(s): return _scrub_nan(json.loads(s))
+        def json_dumps(o): return json.dumps(o, separators=(",", ":"), allow_nan=False).encode()
 
 app = Flask(__name__)
 
@@ -18,50 +36,291 @@ API_BASES = [
 ]
 API_KEY = os.environ.get("MICROBURBS_API_KEY", "")
 
+# Probe threads and pooled connections are sized together so no thread ever waits on
+# the pool for a connection. A cold suburb query is up to 18 attempts; when several
+# requests probe at once the rest wait in the queue.
+PROBE_WORKERS = int(os.environ.get("PROBE_WORKERS", "32"))
+# Seconds a request's probes may run, counted from when its first attempt leaves the
+# executor queue, so time spent behind other users' probes doesn't eat the budget
+PROBE_BUDGET = 16
+
+# One shared client so every attempt reuses the same keep-alive TLS socket.
+# With h2 installed the probes become parallel HTTP/2 streams on that one socket.
+# Redirects are followed, as requests.get did before.
+CLIENT = httpx.Client(
+    http2=importlib.util.find_spec("h2") is not None,
+    timeout=httpx.Timeout(15.0, connect=3.0),
+    limits=httpx.Limits(max_keepalive_connections=PROBE_WORKERS, max_connections=PROBE_WORKERS),
+    headers={"Accept": "application/json"},
+    follow_redirects=True,
+)
+EXECUTOR = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="probe")
+
+# Remember which (base, style) last worked per endpoint so steady state is one request
+AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", "3600"))
+# "*" holds the API-wide combo found by the background HEAD probe in _detect_auth
+_AUTH_CACHE: dict[str, tuple[str, str, float]] = {}
+_AUTH_LOCK = threading.Lock()
+# Detection runs in the background; a failed wave is retried after AUTH_DETECT_RETRY seconds
+AUTH_DETECT_RETRY = int(os.environ.get("AUTH_DETECT_RETRY", "60"))
+_AUTH_DETECTING = False
+_AUTH_DETECT_AFTER = 0.0
+
+# Market data changes slowly, keep recent answers for a while
+MARKET_CACHE_TTL = int(os.environ.get("MARKET_CACHE_TTL", "900"))
+_MARKET_CACHE = TTLCache(maxsize=1024, ttl=MARKET_CACHE_TTL)
+# Queries that came back empty are remembered briefly so retries don't re-probe upstream
+NEG_CACHE_TTL = int(os.environ.get("NEG_CACHE_TTL", "60"))
+_NEG_CACHE = TTLCache(maxsize=1024, ttl=NEG_CACHE_TTL)
+_MARKET_LOCK = threading.Lock()
+
 # --------------- HTTP helpers ---------------
 
-def _call(path: str, params: dict, base: str, style: str):
+# Auth style -> (extra headers, query string suffix), built once
+_AUTH_STYLES = {
+    "query":   ({}, "&" + urlencode({"access_token": API_KEY}) if API_KEY else ""),
+    "xapikey": ({"x-api-key": API_KEY} if API_KEY else {}, ""),
+    "bearer":  ({"Authorization": f"Bearer {API_KEY}"} if API_KEY else {}, ""),
+}
+# Access_token in query first, then headers, across both bases.
+# Without a key all three styles send the same request, so one per base is enough.
+_ATTEMPT_MATRIX = (tuple((b, s) for b in API_BASES for s in ("query", "xapikey", "bearer")) if API_KEY
+                   else tuple((b, "query") for b in API_BASES))
+
+def _call(path: str, qs: str, base: str, style: str):
+    # qs is the variant's query string, encoded once per request in _first_json
     url = f"{base}{path}"
-    headers = {"Accept": "application/json"}
-    q = dict(params)
-    if style == "query":
-        if API_KEY:
-            q["access_token"] = API_KEY
-    elif style == "xapikey":
-        if API_KEY:
-            headers["x-api-key"] = API_KEY
-    elif style == "bearer":
-        if API_KEY:
-            headers["Authorization"] = f"Bearer {API_KEY}"
-    r = requests.get(url, headers=headers, params=q, timeout=15)
-    return r, url, q, headers
-
-def _strict_json(text: str):
+    h_extra, q_extra = _AUTH_STYLES[style]
+    r = CLIENT.send(CLIENT.build_request("GET", f"{url}?{qs}{q_extra}", headers=h_extra), stream=True)
+    return r, url
+
+def _scrub_nan(obj):
+    # Replace NaN and Infinity with None, recursively
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _scrub_nan(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_scrub_nan(v) for v in obj]
+    return obj
+
+def _strict_json(raw: bytes):
     # Convert NaN or Infinity to strict JSON
-    obj = json.loads(text)
-    return json.loads(json.dumps(obj, allow_nan=False))
+    # A strict parser rejects them outright, so only the rare non-strict body takes the slow path
+    try:
+        return json_loads(raw)
+    except ValueError:
+        return _scrub_nan(json.loads(raw))
 
-def _first_json(path: str, variants: list[dict]):
-    # Try access_token in query first, then headers, across both bases
-    attempts = [(b, s) for b in API_BASES for s in ("query", "xapikey", "bearer")]
-    last = None
-    for pv in variants:
-        for base, style in attempts:
-            r, url, q, h = _call(path, pv, base, style)
-            last = {"status": r.status_code, "url": url, "style": style,
-                    "params": q, "content_type": r.headers.get("Content-Type","")}
+def _attempt(path: str, params: dict, qs: str, base: str, style: str):
+    r, url = _call(path, qs, base, style)
+    trace = {"status": r.status_code, "url": url, "style": style,
+             "params": params, "content_type": r.headers.get("Content-Type","")}
+    validators = {"Last-Modified": r.headers["Last-Modified"]} if "Last-Modified" in r.headers else {}
+    if r.status_code >= 300 or "application/json" not in trace["content_type"].lower():
+        # Body is still unread (stream=True), drop it and hand the socket back
+        r.close()
+        return False, None, trace, validators
+    try:
+        return True, _strict_json(r.read()), trace, validators
+    finally:
+        r.close()
+
+def _probe(path: str, attempts: list[tuple]):
+    # Fire every (params, query string, base, style) at once, first JSON answer wins
+    started = []
+    def run(*args):
+        if not started:
+            started.append(time.monotonic())
+        return _attempt(path, *args)
+    futures = {EXECUTOR.submit(run, pv, qs, base, style): (base, style)
+               for pv, qs, base, style in attempts}
+    # "answered" means the upstream really said no: some attempt got a JSON 4xx other
+    # than an auth or throttling status. Redirects, 408/429, 5xx, non-JSON 2xx, errors
+    # and an expired budget are transient. Only answered, clean misses are cacheable.
+    pending, last, answered, clean = set(futures), None, False, True
+    try:
+        while pending:
+            budget = started[0] + PROBE_BUDGET - time.monotonic() if started else PROBE_BUDGET
+            if budget <= 0:
+                clean = False
+                break
+            done, pending = wait(pending, timeout=budget, return_when=FIRST_COMPLETED)
+            for f in done:
+                try:
+                    ok, data, last, validators = f.result()
+                except Exception:
+                    clean = False
+                    continue
+                if ok:
+                    return {"ok": True, "data": data, "trace": last, "auth": futures[f],
+                            "headers": validators}
+                status = last["status"]
+                if 400 <= status < 500 and status not in (401, 403, 408, 429):
+                    answered = answered or "application/json" in last["content_type"].lower()
+                elif status not in (401, 403):
+                    clean = False
+    finally:
+        for f in futures:
+            f.cancel()
+    return {"ok": False, "data": {}, "trace": last or {}, "answered": answered and clean}
+
+def _cached_auth(path: str):
+    with _AUTH_LOCK:
+        hit = _AUTH_CACHE.get(path)
+        if hit and hit[2] < time.monotonic():
+            del _AUTH_CACHE[path]
+            hit = None
+    return hit[:2] if hit else None
+
+def _head(base: str, style: str):
+    h_extra, q_extra = _AUTH_STYLES[style]
+    r = CLIENT.head(f"{base}/suburb/market?suburb=Sydney{q_extra}", headers=h_extra)
+    return r.status_code < 300 and "application/json" in r.headers.get("Content-Type","").lower()
+
+def _run_detect_auth():
+    global _AUTH_DETECTING, _AUTH_DETECT_AFTER
+    found = None
+    futures = {EXECUTOR.submit(_head, base, style): (base, style) for base, style in _ATTEMPT_MATRIX}
+    try:
+        for f in as_completed(futures, timeout=16):
             try:
-                if r.status_code < 300 and "application/json" in last["content_type"].lower():
-                    return {"ok": True, "data": _strict_json(r.text), "trace": last}
+                if f.result():
+                    found = futures[f]
+                    break
             except Exception:
                 continue
-    return {"ok": False, "data": {}, "trace": last or {}}
+    except TimeoutError:
+        pass
+    finally:
+        for f in futures:
+            f.cancel()
+        with _AUTH_LOCK:
+            if found:
+                _AUTH_CACHE["*"] = (*found, time.monotonic() + AUTH_CACHE_TTL)
+            else:
+                _AUTH_DETECT_AFTER = time.monotonic() + AUTH_DETECT_RETRY
+            _AUTH_DETECTING = False
+
+def _detect_auth():
+    # Find a (base, style) the whole API accepts using cheap HEAD requests.
+    # Re-armed whenever "*" is missing, expired or evicted; never blocks the caller.
+    global _AUTH_DETECTING
+    if _cached_auth("*"):
+        return
+    with _AUTH_LOCK:
+        if _AUTH_DETECTING or time.monotonic() < _AUTH_DETECT_AFTER:
+            return
+        _AUTH_DETECTING = True
+    threading.Thread(target=_run_detect_auth, name="detect-auth", daemon=True).start()
+
+def _first_json(path: str, variants: list[dict]):
+    # Try the combo that worked last time (for this path, else API-wide), then the full matrix
+    _detect_auth()
+    queries = [(pv, urlencode(pv, safe=",")) for pv in variants]
+    for key in (path, "*"):
+        auth = _cached_auth(key)
+        if auth:
+            break
+    if auth:
+        result = _probe(path, [(pv, qs, *auth) for pv, qs in queries])
+        if result["ok"]:
+            return result
+        if result["trace"].get("status") in (401, 403):
+            with _AUTH_LOCK:
+                _AUTH_CACHE.pop(key, None)
+    result = _probe(path, [(pv, qs, base, style) for pv, qs in queries for base, style in _ATTEMPT_MATRIX])
+    if result["ok"]:
+        with _AUTH_LOCK:
+            _AUTH_CACHE[path] = (*result["auth"], time.monotonic() + AUTH_CACHE_TTL)
+    return result
+
+# --------------- KPIs ---------------
+
+# Upstream field names vary, so each value is looked up along a list of dotted paths.
+# Each list is compiled once at import into straight-line lookups, no per-call splitting.
+def _compile_picker(*paths):
+    lines = ["def pick(o):"]
+    for p in paths:
+        lines.append("    v = o")
+        for k in p.split("."):
+            lines.append(f"    v = v.get({k!r}) if isinstance(v, dict) else None")
+        lines.append("    if v is not None: return v")
+    lines.append("    return None")
+    ns = {}
+    exec("\n".join(lines), ns)
+    return ns["pick"]
+
+_pick_price   = _compile_picker("timeseries.price", "price_timeseries", "series.price", "prices")
+_pick_yield   = _compile_picker("timeseries.yield", "yield_timeseries", "series.yield", "yields")
+_pick_summary = _compile_picker("summary", "current", "kpis", "metrics")
+_pick_median  = _compile_picker("median_price", "medianPrice", "price_median")
+_pick_ry      = _compile_picker("rental_yield", "rentalYield", "yield")
+_pick_g5      = _compile_picker("growth_5y", "growth5Y", "five_year_growth")
+
+# Monthly points sent to the charts: five years back plus the current month
+SERIES_POINTS = 61
+
+def _to_series(arr):
+    out = []
+    for d in arr if isinstance(arr, list) else ():
+        if not isinstance(d, dict):
+            continue
+        t = d.get("date") or d.get("period") or d.get("t") or d.get("Time")
+        v = next((d[k] for k in ("value", "price", "yield", "v") if d.get(k) is not None), None)
+        if t and v is not None:
+            out.append({"t": t, "v": v})
+    return out
+
+def _growth_5y(price: list[dict]):
+    # Annualised growth from five years back (or the oldest point) to the latest
+    try:
+        e, b = float(price[-1]["v"]), float(price[max(0, len(price) - SERIES_POINTS)]["v"])
+    except (TypeError, ValueError):
+        return None
+    return ((e / b) ** 0.2 - 1) * 100 if b > 0 and e > 0 else None
+
+def _derive(data: dict):
+    # Headline KPIs plus trimmed chart series, all the dashboard needs
+    price = _to_series(_pick_price(data))
+    yld = _to_series(_pick_yield(data))
+    sm = _pick_summary(data) or {}
+    median = _pick_median(sm)
+    if median is None and price:
+        median = price[-1]["v"]
+    ry = _pick_ry(sm)
+    if ry is None and yld:
+        ry = yld[-1]["v"]
+    g5 = _pick_g5(sm)
+    if g5 is None and price:
+        g5 = _growth_5y(price)
+    return {"median": median, "ry": ry, "g5": g5,
+            "price_series": price[-SERIES_POINTS:], "yield_series": yld[-SERIES_POINTS:]}
+
+def _market(key: tuple, path: str, variants: list[dict]):
+    # Derived KPIs for one query, repeat queries are served from memory.
+    # Answers are kept in derived form, genuine empty ones only for NEG_CACHE_TTL.
+    # Transient failures are neither cached here nor by the browser.
+    with _MARKET_LOCK:
+        hit = _MARKET_CACHE.get(key) or _NEG_CACHE.get(key)
+    if hit is not None:
+        return hit
+    result = _first_json(path, variants)
+    result["data"] = _derive(result["data"])
+    with _MARKET_LOCK:
+        if result["ok"]:
+            _MARKET_CACHE[key] = result
+            _NEG_CACHE.pop(key, None)
+        elif result["answered"]:
+            _NEG_CACHE[key] = {**result, "trace": {**result["trace"], "cached": True}}
+        else:
+            result["headers"] = {"Cache-Control": "no-store"}
+    return result
 
 # --------------- UI ---------------
 
-@app.get("/")
-def index():
-    html = r"""
+# The page never changes at runtime: it is kept only as UTF-8 bytes, plus a gzip copy
+_INDEX_BYTES = r"""
 <!doctype html><html><head><meta charset="utf-8"/>
 <title>Microburbs Mini Dashboard - API only</title>
 <meta name="viewport" content="width=device-width, initial-scale=1"/>
@@ -150,36 +409,24 @@ async function j(url){
 }
 const note=m=>{ $("#msg").textContent=m; setTimeout(()=>$("#msg").textContent="",4000); };
 
-function pick(obj, paths){ for(const p of paths){ try{ let v=p.split(".").reduce((o,k)=>o?.[k],obj); if(v!=null) return v; }catch{} } return null; }
-function toS(arr){ return (arr||[]).map(d=>({t:(d.date||d.period||d.t||d.Time), v:(d.value ?? d.price ?? d.yield ?? d.v ?? null)})).filter(d=>d.t && d.v!=null); }
-function series(obj){ const price=pick(obj,["timeseries.price","price_timeseries","series.price","prices"])||[]; const yld=pick(obj,["timeseries.yield","yield_timeseries","series.yield","yields"])||[]; return {price:toS(price), yld:toS(yld)}; }
-function last(a){ return a.length?a[a.length-1]:null; } function back5y(a){ return a.length? a[Math.max(0,a.length-61)] : null; }
-function derive(data){
-  const s = series(data); const sm = pick(data,["summary","current","kpis","metrics"])||{};
-  const median = pick(sm,["median_price","medianPrice","price_median"]) ?? last(s.price)?.v ?? null;
-  const ry     = pick(sm,["rental_yield","rentalYield","yield"]) ?? last(s.yld)?.v ?? null;
-  let g5       = pick(sm,["growth_5y","growth5Y","five_year_growth"]);
-  if(g5==null && s.price.length){ const e=last(s.price), b=back5y(s.price); if(b && b.v>0 && e.v>0) g5=(Math.pow(e.v/b.v,1/5)-1)*100; }
-  return {median, ry, g5, s};
-}
 function showSuburb(payload){
-  const data = payload.__data, trace = payload.__trace;
-  const k=derive(data||{});
+  const k = payload.derived||{}, trace = payload.__trace;
+  const ps = k.price_series||[], ys = k.yield_series||[];
   $("#s-price").textContent= k.median!=null?aud(k.median):"–";
   $("#s-yield").textContent= k.ry!=null?pct(k.ry):"–";
   $("#s-growth").textContent= k.g5!=null?pct(k.g5):"–";
-  draw("#s-chart-price", k.s.price.map(d=>d.t), k.s.price.map(d=>d.v), "sP");
-  draw("#s-chart-yield", k.s.yld.map(d=>d.t),   k.s.yld.map(d=>d.v), "sY");
+  draw("#s-chart-price", ps.map(d=>d.t), ps.map(d=>d.v), "sP");
+  draw("#s-chart-yield", ys.map(d=>d.t), ys.map(d=>d.v), "sY");
   $("#s-trace").textContent = trace ? `suburb: ${trace.status} ${trace.content_type}  ->  ${trace.url}  params=${JSON.stringify(trace.params)}` : "";
 }
 function showProperty(payload){
-  const data = payload.__data, trace = payload.__trace;
-  const k=derive(data||{});
+  const k = payload.derived||{}, trace = payload.__trace;
+  const ps = k.price_series||[], ys = k.yield_series||[];
   $("#p-price").textContent= k.median!=null?aud(k.median):"–";
   $("#p-yield").textContent= k.ry!=null?pct(k.ry):"–";
   $("#p-growth").textContent= k.g5!=null?pct(k.g5):"–";
-  draw("#p-chart-price", k.s.price.map(d=>d.t), k.s.price.map(d=>d.v), "pP");
-  draw("#p-chart-yield", k.s.yld.map(d=>d.t),   k.s.yld.map(d=>d.v), "pY");
+  draw("#p-chart-price", ps.map(d=>d.t), ps.map(d=>d.v), "pP");
+  draw("#p-chart-yield", ys.map(d=>d.t), ys.map(d=>d.v), "pY");
   $("#p-trace").textContent = trace ? `property: ${trace.status} ${trace.content_type}  ->  ${trace.url}  params=${JSON.stringify(trace.params)}` : "";
 }
 
@@ -201,34 +448,61 @@ $("#goProp").onclick=async()=>{
   }catch(e){ note(e.message); }
 };
 </script></body></html>
-"""
-    return Response(html, content_type="text/html")
+""".encode("utf-8")
+_INDEX_GZ = gzip.compress(_INDEX_BYTES, compresslevel=9)
+_INDEX_ETAG = hashlib.md5(_INDEX_BYTES).hexdigest()
+_INDEX_GZ_ETAG = hashlib.md5(_INDEX_GZ).hexdigest()
+
+@app.get("/")
+def index():
+    gz = request.accept_encodings["gzip"] > 0
+    body, etag = (_INDEX_GZ, _INDEX_GZ_ETAG) if gz else (_INDEX_BYTES, _INDEX_ETAG)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "public, max-age=300", "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    if gz:
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, content_type="text/html; charset=utf-8", headers=headers)
 
 # --------------- API routes ---------------
 
+def _json_response(payload, status: int = 200, headers: dict | None = None):
+    # Body is already bytes, so Werkzeug can hand it to the server as is.
+    # Successful bodies carry a content-hash ETag so unchanged refreshes get a bare 304.
+    body = json_dumps(payload)
+    headers = dict(headers or {})
+    if status == 200:
+        etag = hashlib.md5(body).hexdigest()
+        headers["ETag"] = f'"{etag}"'
+        headers.setdefault("Cache-Control", "private, max-age=60")
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+    headers["Content-Length"] = str(len(body))
+    return Response(body, status=status, content_type="application/json", direct_passthrough=True,
+                    headers=headers)
+
 @app.get("/api/suburb/market")
 def suburb_market():
     suburb = request.args.get("suburb","").strip()
     state  = request.args.get("state","").strip()
     if not suburb:
-        return Response(json.dumps({"error": "suburb is required"}), status=400, content_type="application/json")
+        return _json_response({"error": "suburb is required"}, status=400)
     variants = [{"suburb": suburb}]
     if state:
         variants += [{"suburb": suburb, "state": state},
                      {"suburb": suburb, "state_code": state}]
-    result = _first_json("/suburb/market", variants)
-    out = result["data"] if result["ok"] else {}
-    return Response(json.dumps({"__data": out, "__trace": result.get("trace")}), content_type="application/json")
+    result = _market(("/suburb/market", suburb.lower(), state.upper()), "/suburb/market", variants)
+    return _json_response({"derived": result["data"], "__trace": result.get("trace")}, headers=result.get("headers"))
 
 @app.get("/api/property/market")
 def property_market():
     pid = (request.args.get("id") or "").strip()
     if not pid:
-        return Response(json.dumps({"error": "id is required"}), status=400, content_type="application/json")
-    result = _first_json("/property/market", [{"id": pid}])
-    out = result["data"] if result["ok"] else {}
-    return Response(json.dumps({"__data": out, "__trace": result.get("trace")}), content_type="application/json")
+        return _json_response({"error": "id is required"}, status=400)
+    result = _market(("/property/market", pid.upper()), "/property/market", [{"id": pid}])
+    return _json_response({"derived": result["data"], "__trace": result.get("trace")}, headers=result.get("headers"))
 
 if __name__ == "__main__":
+    # Local development only, deploy with gunicorn (see gunicorn.conf.py)
     port = int(os.environ.get("PORT","5000"))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port, debug=os.environ.get("FLASK_DEBUG") == "1")
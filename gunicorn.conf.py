@@ -0,0 +1,13 @@
+# gunicorn.conf.py
+# Production server settings, picked up automatically by: gunicorn app:app
+# gthread workers so slow upstream probes don't block other dashboard users.
+# Keep-alive lets the browser's repeated API fetches reuse one connection.
+
+import multiprocessing, os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = 60
+keepalive = 30